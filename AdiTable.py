@@ -0,0 +1,134 @@
+# Class to contain the ADI rankings of every FIPS code in an ADI data file
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+# pyarrow is only imported when an ADI CSV file is parsed (not when reading a saved AdiTable)
+if TYPE_CHECKING:
+    import pyarrow as pa
+
+# ADI data is keyed by 12-digit FIPS codes, which are stored as integers (12 digits fit in 40 bits)
+_FIPS_DTYPE = np.uint64
+_MAX_FIPS = 10**12 - 1
+_FIPS_PATTERN = "^[0-9]{1,12}$"
+
+
+def _file_stat(path: Path) -> list[int]:
+    """Returns a file's size and modification time (in ns), to identify a version of the file.
+    The time is compared exactly rather than as newer/older, since unzipping a download can give a
+    replaced file an older modification time.
+    """
+    stat = path.stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+@dataclass
+class AdiTable:
+    """Lookup table from 12-digit FIPS codes to (state rank, national rank).
+    Stored as parallel arrays instead of a dict of strings, which keeps a whole ADI release
+    (~240,000 block groups) in a few MB instead of tens of MB of Python objects:
+        * FIPS codes are sorted 64-bit integers, searched with a binary search
+        * Ranks are stored as small integer indexes into a list of every distinct rank string
+    """
+
+    # Sorted FIPS codes, as integers
+    fips: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=_FIPS_DTYPE))
+    # Index into rank_labels for each FIPS code's ranks
+    state_ranks: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.uint8))
+    national_ranks: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.uint8))
+    # Mostly integers, but could also be "suppression code" strings
+    rank_labels: list[str] = field(default_factory=list)
+
+    @classmethod
+    def from_columns(
+        cls,
+        fips: "pa.ChunkedArray",
+        state_ranks: "pa.ChunkedArray",
+        national_ranks: "pa.ChunkedArray",
+    ) -> "AdiTable":
+        """Builds an AdiTable from string columns of an ADI data file.
+        Rows with a null or invalid FIPS code are dropped.
+        """
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        # Values that are not FIPS codes (e.g. empty cells) are set to null before the cast to integers,
+        # which would otherwise fail on the whole column
+        is_valid = pc.match_substring_regex(fips, _FIPS_PATTERN)
+        invalid_count = pc.sum(pc.invert(is_valid), min_count=0).as_py()
+        if invalid_count > 0:
+            print(f"Skipped {invalid_count} invalid FIPS code(s) in ADI data")
+        fips = pc.if_else(is_valid, fips, pa.scalar(None, pa.string()))
+        columns = pa.table(
+            {"fips": pc.cast(fips, pa.uint64()), "state": state_ranks, "national": national_ranks}
+        )
+        columns = columns.filter(pc.is_valid(columns["fips"])).sort_by("fips")
+
+        # Every distinct rank string, shared by both rank columns
+        rank_labels = pc.unique(
+            pa.chunked_array(columns["state"].chunks + columns["national"].chunks, pa.string())
+        )
+        rank_dtype = np.min_scalar_type(max(len(rank_labels) - 1, 0))
+
+        def rank_indexes(ranks: "pa.ChunkedArray") -> np.ndarray:
+            return pc.index_in(ranks, rank_labels).to_numpy().astype(rank_dtype)
+
+        return cls(
+            fips=columns["fips"].to_numpy(),
+            state_ranks=rank_indexes(columns["state"]),
+            national_ranks=rank_indexes(columns["national"]),
+            rank_labels=rank_labels.to_pylist(),
+        )
+
+    @classmethod
+    def load(cls, npz_path: Path, source_csv: Path) -> "AdiTable | None":
+        """Reads an AdiTable previously written by AdiTable.save().
+        Returns None if `source_csv` is not exactly the file the AdiTable was built from
+        (i.e. its size or modification time has changed since), or was saved without this info.
+        """
+        with np.load(npz_path, allow_pickle=False) as npz:
+            if "source_stat" not in npz.files or npz["source_stat"].tolist() != _file_stat(
+                source_csv
+            ):
+                return None
+            return cls(
+                fips=npz["fips"],
+                state_ranks=npz["state_ranks"],
+                national_ranks=npz["national_ranks"],
+                rank_labels=npz["rank_labels"].tolist(),
+            )
+
+    def save(self, npz_path: Path, source_csv: Path) -> None:
+        """Writes this AdiTable's arrays to an uncompressed .npz file, to be read by AdiTable.load().
+        The size and modification time of `source_csv` (the file this AdiTable was built from) are
+        saved with it, so a changed source file can be detected.
+        """
+        np.savez(
+            npz_path,
+            source_stat=np.array(_file_stat(source_csv), dtype=np.int64),
+            fips=self.fips,
+            state_ranks=self.state_ranks,
+            national_ranks=self.national_ranks,
+            rank_labels=np.array(self.rank_labels, dtype=str),
+        )
+
+    def __len__(self) -> int:
+        return len(self.fips)
+
+    def get(self, fips: int) -> tuple[str, str] | None:
+        """Returns the ranks for a 12-digit FIPS code (as an integer) as a tuple: (state, national)
+        Returns None if the FIPS code is not in this table.
+        """
+        if not 0 <= fips <= _MAX_FIPS:
+            return None
+        key = _FIPS_DTYPE(fips)
+        i = np.searchsorted(self.fips, key)
+        if i < len(self.fips) and self.fips[i] == key:
+            return (
+                self.rank_labels[self.state_ranks[i]],
+                self.rank_labels[self.national_ranks[i]],
+            )
+        return None
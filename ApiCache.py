@@ -0,0 +1,138 @@
+# Class to save web API results on disk, so addresses are not looked up again on later runs
+
+import hashlib
+import sqlite3
+import threading
+from collections.abc import Iterable
+from pathlib import Path
+from types import TracebackType
+
+# Coordinates are rounded to this many decimal places (~10 cm) when used as a cache key
+_COORDINATE_DECIMALS = 6
+
+
+def _address_hash(address: str) -> bytes:
+    """Returns the key an address is saved under, so the cache file never contains the address."""
+    return hashlib.blake2b(address.encode(), digest_size=16).digest()
+
+
+class ApiCache:
+    """SQLite-backed cache of geocoding and FCC API results.
+    Only successful lookups are saved, so failed addresses are retried on the next run.
+    One ApiCache can be shared by multiple threads.
+    """
+
+    def __init__(self, db_path: Path) -> None:
+        # Worker threads share one connection; the lock keeps their queries from interleaving
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            # Caches from older versions saved addresses in plaintext; those entries are deleted
+            latlong_columns = [
+                row[1] for row in self._connection.execute("PRAGMA table_info(latlong)")
+            ]
+            erase_plaintext = "address" in latlong_columns
+            if erase_plaintext:
+                self._connection.execute("DROP TABLE latlong")
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS latlong (
+                    address_hash BLOB PRIMARY KEY,
+                    latitude REAL NOT NULL,
+                    longitude REAL NOT NULL
+                )"""
+            )
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS fips (
+                    latitude REAL NOT NULL,
+                    longitude REAL NOT NULL,
+                    census_year INTEGER NOT NULL,
+                    fips TEXT NOT NULL,
+                    PRIMARY KEY (latitude, longitude, census_year)
+                )"""
+            )
+        if erase_plaintext:
+            # Rewrites the file, so the dropped addresses do not linger in free pages
+            with self._lock:
+                self._connection.execute("VACUUM")
+
+    def __enter__(self) -> "ApiCache":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def get_latlong(self, address: str) -> tuple[float, float] | None:
+        """Returns the cached (latitude, longitude) of an address, or None if not cached."""
+        with self._lock:
+            return self._connection.execute(
+                "SELECT latitude, longitude FROM latlong WHERE address_hash = ?",
+                (_address_hash(address),),
+            ).fetchone()
+
+    def set_latlong(self, address: str, latitude: float, longitude: float) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO latlong VALUES (?, ?, ?)",
+                (_address_hash(address), latitude, longitude),
+            )
+
+    def get_fips(self, latitude: float, longitude: float, census_year: int) -> str | None:
+        """Returns the cached FIPS code of a pair of coordinates, or None if not cached."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT fips FROM fips WHERE latitude = ? AND longitude = ? AND census_year = ?",
+                (
+                    round(latitude, _COORDINATE_DECIMALS),
+                    round(longitude, _COORDINATE_DECIMALS),
+                    census_year,
+                ),
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def set_fips(self, latitude: float, longitude: float, census_year: int, fips: str) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO fips VALUES (?, ?, ?, ?)",
+                (
+                    round(latitude, _COORDINATE_DECIMALS),
+                    round(longitude, _COORDINATE_DECIMALS),
+                    census_year,
+                    fips,
+                ),
+            )
+
+    def set_address_results(self, results: Iterable[tuple[str, float, float, int, str]]) -> None:
+        """Saves many addresses' coordinates and FIPS codes in one transaction.
+        Each result is a tuple: (address, latitude, longitude, census year, FIPS code)
+        """
+        results = list(results)
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO latlong VALUES (?, ?, ?)",
+                (
+                    (_address_hash(address), latitude, longitude)
+                    for address, latitude, longitude, _, _ in results
+                ),
+            )
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO fips VALUES (?, ?, ?, ?)",
+                (
+                    (
+                        round(latitude, _COORDINATE_DECIMALS),
+                        round(longitude, _COORDINATE_DECIMALS),
+                        census_year,
+                        fips,
+                    )
+                    for _, latitude, longitude, census_year, fips in results
+                ),
+            )
@@ -1,13 +1,33 @@
 # Class to contain data for each address and associated location data
 
-import random
-import time
-import urllib
-from dataclasses import dataclass
+import csv
+import io
+import itertools
+import operator
+import re
+from collections.abc import Callable, Sequence
+from dataclasses import dataclass, field
 from string import digits as DIGITS
+from typing import TYPE_CHECKING
 
-import requests
-from geopy.geocoders import GoogleV3
+import orjson
+
+from AdiTable import AdiTable
+from ApiCache import ApiCache
+
+# Only used in type annotations, so these are not imported at run time
+if TYPE_CHECKING:
+    import requests
+    from geopy.location import Location as GeopyLocation
+
+FCC_API_URL = "https://geo.fcc.gov/api/census/block/find"
+# Query parameters are only numbers, so the full URL can be filled in without URL-encoding
+_FCC_API_URL_TEMPLATE = (
+    FCC_API_URL + "?latitude={latitude}&longitude={longitude}&censusYear={census_year}&format=json"
+)
+CENSUS_BATCH_API_URL = "https://geocoding.geo.census.gov/geocoder/geographies/addressbatch"
+# The Census Geocoder accepts up to 10,000 addresses per batch, but smaller batches return sooner
+CENSUS_BATCH_SIZE = 1000
 
 _PO_BOX_CHECKS = {
     "POBOX",
@@ -24,14 +44,68 @@ _PO_BOX_CHECKS = {
     "P.O.BOX",
 }
 
+# Column names of the output CSV, in the order of Location.prep_for_output()
+OUTPUT_FIELDS = (
+    "street",
+    "apt_num",
+    "city",
+    "state",
+    "zipcode",
+    "census_year",
+    "latitude",
+    "longitude",
+    "fips",
+    "adi_version",
+    "adi_state",
+    "adi_national",
+)
+
+# Reads every output column from a Location in a single C-level call
+_get_output_fields = operator.attrgetter(*OUTPUT_FIELDS)
+
+# How to convert a FIPS code of a given length to the 12-digit integer used by ADI data:
+# the number to divide the FIPS code (as an integer) by
+_FIPS_LENGTH_TO_12_DIGIT_DIVISOR = {
+    12: 1,
+    # 14-char: the leading 0 of the state code was dropped, which does not change the integer;
+    # dropping the last 3 digits (the block) leaves the block group
+    14: 1000,
+    # 15-char: dropping the last 3 digits (block-level FIPS code)
+    15: 1000,
+}
+
 _MILITARY_MAIL_POST_OFFICE = {"APO", "FPO", "DPO"}
 _MILITARY_MAIL_STATES = {"AA", "AP", "AE"}
 
+# USPS abbreviations of the states, DC, and the territories covered by US Census FIPS codes
+_US_STATES = frozenset(
+    {
+        "AL", "AK", "AZ", "AR", "CA", "CO", "CT", "DE", "FL", "GA",
+        "HI", "ID", "IL", "IN", "IA", "KS", "KY", "LA", "ME", "MD",
+        "MA", "MI", "MN", "MS", "MO", "MT", "NE", "NV", "NH", "NJ",
+        "NM", "NY", "NC", "ND", "OH", "OK", "OR", "PA", "RI", "SC",
+        "SD", "TN", "TX", "UT", "VT", "VA", "WA", "WV", "WI", "WY",
+        "DC", "PR", "GU", "VI", "AS", "MP",
+    }
+)  # fmt: skip
+# 5-digit ZIP or ZIP+4; 4 digits are also accepted, since spreadsheet programs often drop the
+# leading zero of ZIP codes in the Northeast (e.g. 02134 -> 2134)
+_ZIP_CODE_REGEX = re.compile("[0-9]{4,5}(-?[0-9]{4})?")
+
+# Each set of substrings is compiled into one pattern, so an address is scanned once per set
+# instead of once per substring
+_PO_BOX_REGEX = re.compile("|".join(re.escape(i) for i in sorted(_PO_BOX_CHECKS)))
+_MILITARY_MAIL_POST_OFFICE_REGEX = re.compile(
+    "|".join(re.escape(i) for i in sorted(_MILITARY_MAIL_POST_OFFICE))
+)
+
 # Proudly using dataclasses for less boilerplate code :)
 # https://docs.python.org/3/library/dataclasses.html
 
 
-@dataclass
+# slots=True: instances store their attributes in fixed slots instead of a per-instance __dict__,
+# which reduces memory use for large address files
+@dataclass(slots=True)
 class Location:
     # Variables required on object instantiation
     street: str
@@ -54,111 +128,290 @@ class Location:
     adi_state: str = ""
     adi_national: str = ""
 
+    # Uppercased address fields, computed once for the substring checks in can_geocode()
+    _street_upper: str = field(init=False, repr=False, compare=False)
+    _city_upper: str = field(init=False, repr=False, compare=False)
+    _state_upper: str = field(init=False, repr=False, compare=False)
+    # Full address string, computed once and used for geocoding and as the API cache key
+    _full_address: str = field(init=False, repr=False, compare=False)
+    # Full address uppercased with runs of whitespace collapsed, to recognize repeated addresses
+    _address_key: str = field(init=False, repr=False, compare=False)
+    # Messages about this Location's lookups, printed together by whoever processes it
+    # (Locations are processed in parallel, so printing each message right away would mix them up)
+    _messages: list[str] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        self._messages = []
+        self._street_upper = self.street.upper()
+        self._city_upper = self.city.upper()
+        self._state_upper = self.state.upper()
+        self._full_address = " ".join(
+            [self.street, self.apt_num, self.city, self.state, self.zipcode]
+        )
+        self._address_key = " ".join(self._full_address.upper().split())
+
+    def _log(self, message: str) -> None:
+        self._messages.append(message)
+
+    def pop_messages(self) -> list[str]:
+        """Returns the messages logged while processing this Location, and clears them."""
+        messages, self._messages = self._messages, []
+        return messages
+
     def get_full_address(self) -> str:
         """Returns a string containing the full address of this Location.
         This string is composed of multiple attributes, and not all attributes are guaranteed to be present,
         so sequences of double spaces "  " may occur where an empty attribute is found.
         """
-        return " ".join([self.street, self.apt_num, self.city, self.state, self.zipcode])
+        return self._full_address
+
+    def get_address_key(self) -> str:
+        """Returns a normalized form of the full address of this Location (uppercased, with
+        whitespace collapsed), which is the same for addresses that differ only in case or spacing.
+        """
+        return self._address_key
 
     def can_geocode(self) -> bool:
         """Returns True if a Location is eligible for geocoding.
         A Location is eligible for geocoding if:
         (1) all 3 of its street, city, and state fields are not empty,
-        (2) the Location's address is not a Military Mail address, and
-        (3) the Location's address is not a PO box
+        (2) the Location's address is not a Military Mail address,
+        (3) its state (if abbreviated) is a US state or territory, and its ZIP code (if any) is valid
+        (4) the Location's address is not a PO box
+        These local checks skip API calls that could not find a valid US location anyway.
         """
-        _street_upper = self.street.upper()
-        _city_upper = self.city.upper()
-        _state_upper = self.state.upper()
+        # Checks are ordered cheapest-first, and each one returns as soon as it fails
+        if len(self.street) == 0 or len(self.city) == 0 or len(self.state) == 0:
+            return False
 
         # https://www.usps.com/ship/apo-fpo-dpo.htm
         is_military_address = (
-            any([i for i in _MILITARY_MAIL_POST_OFFICE if i in _city_upper])
-            or _state_upper in _MILITARY_MAIL_STATES
-            or "PSC " in _street_upper
+            self._state_upper in _MILITARY_MAIL_STATES
+            or "PSC " in self._street_upper
+            or _MILITARY_MAIL_POST_OFFICE_REGEX.search(self._city_upper) is not None
         )
+        if is_military_address:
+            return False
 
-        street_has_po_box = any([i for i in _PO_BOX_CHECKS if i in _street_upper])
+        # Full state names are left for the geocoder to interpret
+        state = self._state_upper.strip()
+        if len(state) == 2 and state not in _US_STATES:
+            return False
+        zipcode = self.zipcode.strip()
+        if zipcode and _ZIP_CODE_REGEX.fullmatch(zipcode) is None:
+            return False
 
-        return (
-            len(self.street) > 0
-            and len(self.city) > 0
-            and len(self.state) > 0
-            and not is_military_address
-            and not street_has_po_box
-        )
+        street_has_po_box = _PO_BOX_REGEX.search(self._street_upper) is not None
+        return not street_has_po_box
 
-    def get_latlong(self, geocoder: GoogleV3) -> tuple[float]:
+    def get_latlong(
+        self, geocode: Callable[..., "GeopyLocation | None"], cache: ApiCache | None = None
+    ) -> tuple[float, float] | tuple[()]:
         """Sets the latitude and longitude coordinates for this Location.
         Returns the coordinates as a tuple: (latitude, longitude)
-        Coordinate data is provided by the Google Maps Geocoding API."""
+        Coordinate data is provided by the Google Maps Geocoding API.
+        `geocode` is expected to be a rate-limited wrapper around a geocoder's `geocode` method.
+        If a cache is given, coordinates found there skip the API call, and new coordinates are saved.
+        Does nothing if this Location already has coordinates (e.g. from Location.batch_fips()).
+        """
+        if self.latitude is not None and self.longitude is not None:
+            return (self.latitude, self.longitude)
         if self.can_geocode():
             try:
                 full_address = self.get_full_address()
-                time.sleep(0.5 + random.random())  # rate limiting
+                cached_latlong = cache.get_latlong(full_address) if cache is not None else None
+                if cached_latlong is not None:
+                    self.latitude, self.longitude = cached_latlong
+                    return (self.latitude, self.longitude)
                 # THE API CALL:
-                location_query_result = geocoder.geocode(query=full_address)
+                location_query_result = geocode(query=full_address)
                 if location_query_result is None:
                     # If the geocode returns no results, try again without the address number
                     alternate_address = full_address.lstrip(DIGITS)
-                    print(f"        Attempting alternate address '{alternate_address}'")
+                    self._log(f"Attempting alternate address '{alternate_address}'")
                     # THE BACKUP API CALL:
-                    location_query_result = geocoder.geocode(query=alternate_address)
+                    location_query_result = geocode(query=alternate_address)
 
                 if location_query_result is not None:
                     # API call was successful
                     location_geometry = location_query_result.raw["geometry"]["location"]
                     self.latitude = location_geometry["lat"]
                     self.longitude = location_geometry["lng"]
+                    if cache is not None:
+                        cache.set_latlong(full_address, self.latitude, self.longitude)
                     return (self.latitude, self.longitude)
             except Exception as e:
-                print(f"        Encountered an error with geocoding: {e}")
+                self._log(f"Encountered an error with geocoding: {e}")
         else:
-            print("This address is not eligible for geocoding")
+            self._log("This address is not eligible for geocoding")
         return ()
 
-    def get_fips(self) -> str:
+    def load_cached(self, cache: ApiCache) -> bool:
+        """Sets the latitude/longitude coordinates and FIPS code of this Location from the results
+        of earlier runs, without any API calls.
+        Returns True if both were found in the cache (so this Location needs no API calls at all).
+        """
+        if not self.can_geocode():
+            return False
+        cached_latlong = cache.get_latlong(self.get_full_address())
+        if cached_latlong is None:
+            return False
+        self.latitude, self.longitude = cached_latlong
+        cached_fips = cache.get_fips(self.latitude, self.longitude, self.census_year)
+        if cached_fips is None:
+            return False
+        self.fips = cached_fips
+        return True
+
+    def get_fips(
+        self, http_get: Callable[..., "requests.Response"], cache: ApiCache | None = None
+    ) -> str:
         """Sets the FIPS code for this Location.
         Returns the FIPS code as a string.
         FIPS data is provided by the US FCC Area API.
+        `http_get` is expected to be a rate-limited wrapper around a shared `requests.Session.get`.
+        If a cache is given, FIPS codes found there skip the API call, and new FIPS codes are saved.
+        Does nothing if this Location already has a FIPS code (e.g. from Location.batch_fips()).
         """
+        if self.fips:
+            return self.fips
         if self.latitude is None or self.longitude is None:
-            print("FIPS code requires latitude/longitude coordinates.")
+            self._log("FIPS code requires latitude/longitude coordinates.")
             return ""
+        if cache is not None:
+            cached_fips = cache.get_fips(self.latitude, self.longitude, self.census_year)
+            if cached_fips is not None:
+                self.fips = cached_fips
+                return cached_fips
         # Census year specified in main.py
-        url_params = urllib.parse.urlencode(
-            {
-                "latitude": self.latitude,
-                "longitude": self.longitude,
-                "censusYear": self.census_year,
-                "format": "json",
-            }
+        fcc_api_url = _FCC_API_URL_TEMPLATE.format(
+            latitude=self.latitude, longitude=self.longitude, census_year=self.census_year
         )
-        fcc_api_url = "https://geo.fcc.gov/api/census/block/find"
         try:
-            # print(f"        Requesting URL {url}?{params}")
-            time.sleep(0.5 + random.random())  # rate limiting
-            api_response = requests.get(url=fcc_api_url, params=url_params)
-            data = api_response.json()
+            # print(f"        Requesting URL {fcc_api_url}")
+            api_response = http_get(fcc_api_url, timeout=10)
+            data = orjson.loads(api_response.content)
             if isinstance(data, dict) and "Block" in data and "FIPS" in data["Block"]:
                 fips_code = data["Block"]["FIPS"]
                 if fips_code:
                     # API call was successful
                     self.fips = fips_code
+                    if cache is not None:
+                        cache.set_fips(self.latitude, self.longitude, self.census_year, fips_code)
                     return fips_code
                 else:
-                    # requests translates null JSON values to Python's None object
-                    print("        FCC API returned nothing")
+                    # orjson translates null JSON values to Python's None object
+                    self._log("FCC API returned nothing")
             else:
-                print(
-                    f"        Got data in an unexpected format from FCC API: {api_response.text}"
-                )
+                self._log(f"Got data in an unexpected format from FCC API: {api_response.text}")
         except Exception as e:
-            print(f"        Encountered an error with FCC API call: {e}")
+            self._log(f"Encountered an error with FCC API call: {e}")
         return ""
 
-    def get_adi(self, adi_version: str, adi_data: dict) -> tuple[str]:
+    @staticmethod
+    def batch_fips(
+        locations: Sequence["Location"],
+        http_post: Callable[..., "requests.Response"],
+        cache: ApiCache | None = None,
+    ) -> int:
+        """Sets the FIPS codes (and latitude/longitude coordinates) of many Locations at once by
+        uploading their addresses to the US Census Geocoder batch API, CENSUS_BATCH_SIZE addresses
+        per request. Exactly matched Locations then need no other API calls.
+        Returns the number of Locations whose FIPS code was set.
+        Locations that are not eligible for geocoding or that the Census Geocoder could not match
+        exactly are left unchanged, so they can still be geocoded and looked up one at a time.
+        `http_post` is expected to be a shared `requests.Session.post`.
+        If a cache is given, the matched coordinates and FIPS codes are saved to it.
+        """
+        eligible_locations = [loc for loc in locations if not loc.fips and loc.can_geocode()]
+        fips_found = 0
+        for batch in itertools.batched(eligible_locations, CENSUS_BATCH_SIZE):
+            # Uploaded CSV columns: unique ID, street, city, state, ZIP (no header)
+            address_file = io.StringIO()
+            writer = csv.writer(address_file, lineterminator="\n")
+            for i, location in enumerate(batch):
+                writer.writerow(
+                    (i, location.street, location.city, location.state, location.zipcode)
+                )
+            try:
+                api_response = http_post(
+                    CENSUS_BATCH_API_URL,
+                    data={
+                        "benchmark": "Public_AR_Current",
+                        # Census year specified in main.py
+                        "vintage": f"Census{batch[0].census_year}_Current",
+                    },
+                    files={"addressFile": ("addresses.csv", address_file.getvalue(), "text/csv")},
+                    # Large batches can take several minutes to process
+                    timeout=600,
+                )
+                api_response.raise_for_status()
+                # Results to save to the cache: (address, latitude, longitude, census year, FIPS)
+                matched_results = []
+                # Matched rows: unique ID, input address, "Match", match type, matched address,
+                # "longitude,latitude", TIGER line ID, side, state, county, tract, block
+                for row in csv.reader(io.StringIO(api_response.text)):
+                    # "Non_Exact" matches can be a different address, so those are left to be
+                    # geocoded one by one
+                    if len(row) < 12 or row[2] != "Match" or row[3] != "Exact":
+                        continue
+                    fips_code = "".join(row[8:12])
+                    if len(fips_code) == 15 and fips_code.isdigit():
+                        location = batch[int(row[0])]
+                        location.fips = fips_code
+                        fips_found += 1
+                        longitude, _, latitude = row[5].partition(",")
+                        if latitude and longitude:
+                            location.latitude = float(latitude)
+                            location.longitude = float(longitude)
+                            matched_results.append(
+                                (
+                                    location.get_full_address(),
+                                    location.latitude,
+                                    location.longitude,
+                                    location.census_year,
+                                    fips_code,
+                                )
+                            )
+                if cache is not None:
+                    cache.set_address_results(matched_results)
+            except Exception as e:
+                print(f"        Encountered an error with Census Geocoder batch API call: {e}")
+        return fips_found
+
+    def copy_results(self, other: "Location") -> None:
+        """Sets the coordinates, FIPS code, and ADI info of this Location to those of another
+        Location (e.g. one with the same address that has already been processed).
+        """
+        self.latitude = other.latitude
+        self.longitude = other.longitude
+        self.fips = other.fips
+        self.adi_version = other.adi_version
+        self.adi_state = other.adi_state
+        self.adi_national = other.adi_national
+
+    def process(
+        self,
+        geocode: Callable[..., "GeopyLocation | None"],
+        http_get: Callable[..., "requests.Response"],
+        adi_version: str,
+        adi_data: AdiTable,
+        cache: ApiCache | None = None,
+    ) -> None:
+        """Runs every lookup step for this Location, in order:
+        latitude/longitude coordinates, then FIPS code, then ADI rankings.
+        """
+        self.get_latlong(geocode, cache)
+        self.get_fips(http_get, cache)
+        self.get_adi(adi_version, adi_data)
+
+    def prep_for_output(self) -> tuple:
+        """Returns the data of this Location as a row of the output CSV, in the order of OUTPUT_FIELDS.
+        Read directly from the attributes, skipping the recursive copy done by dataclasses.asdict().
+        """
+        return _get_output_fields(self)
+
+    def get_adi(self, adi_version: str, adi_data: AdiTable) -> tuple[str, str] | tuple[()]:
         """Sets the state and national ADI ranks for this Location.
         Also sets the ADI version.
         Returns the ranks as a tuple: (state, national)
@@ -166,7 +419,7 @@ class Location:
         (See "Suppression Codes" in the ADI data's accompanying .txt file for more details.)
         """
         if len(self.fips) == 0:
-            print("ADI scores require FIPS code.")
+            self._log("ADI scores require FIPS code.")
             return ()
         if len(adi_version) > 0:
             # Filename could be a bit long and wasteful if stored in bulk;
@@ -175,26 +428,18 @@ class Location:
 
         # ADI data expects 12-digit FIPS codes for lookup
         # FIPS data is not guaranteed to be 12 chars long; FCC API usually provides 15-char codes but could be 14 chars long
-        fips_for_lookup = self.fips
-        match len(fips_for_lookup):
-            case 12:
-                pass
-            case 14:
-                # print(
-                #     "        14-char FIPS: Adding a leading 0 and truncating to 12 chars for ADI lookup only"
-                # )
-                fips_for_lookup = f"0{fips_for_lookup}"[:12]
-            case 15:
-                # print(
-                #     "        15-char FIPS: Truncating to 12 chars for ADI lookup only"
-                # )
-                fips_for_lookup = fips_for_lookup[:12]
-            case _:
-                print(
-                    f"        Invalid FIPS length: {len(fips_for_lookup)} (expected 12-, 14-, or 15-char long FIPS code)"
-                )
-                return ()
-        if fips_for_lookup in adi_data:
-            self.adi_state, self.adi_national = adi_data[fips_for_lookup]
-            return (self.adi_state, self.adi_national)
+        divisor = _FIPS_LENGTH_TO_12_DIGIT_DIVISOR.get(len(self.fips))
+        if divisor is None:
+            self._log(
+                f"Invalid FIPS length: {len(self.fips)} (expected 12-, 14-, or 15-char long FIPS code)"
+            )
+            return ()
+        if not (self.fips.isascii() and self.fips.isdigit()):
+            self._log(f"Invalid FIPS code: '{self.fips}' (expected only digits)")
+            return ()
+        # ADI data is keyed by integers, so the FIPS code is converted once instead of sliced
+        adi_ranks = adi_data.get(int(self.fips) // divisor)
+        if adi_ranks is not None:
+            self.adi_state, self.adi_national = adi_ranks
+            return adi_ranks
         return ()
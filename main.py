@@ -1,13 +1,24 @@
 import csv
+import functools
 import json
-import re
-from dataclasses import asdict
+import queue
+import threading
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
+from typing import TYPE_CHECKING, Any, TextIO
 
-from geopy.geocoders import GoogleV3
+from AdiTable import AdiTable
+from ApiCache import ApiCache
+from Location import OUTPUT_FIELDS, Location
 
-from Location import Location
+# geopy, requests, and pyarrow take a few hundred ms to import, so they are only imported once
+# they are needed (e.g. not when the address or secrets file is missing, or ADI data is cached)
+if TYPE_CHECKING:
+    import pyarrow as pa
+    from geopy.extra.rate_limiter import RateLimiter
 
 # Used to look up FIPS codes
 CENSUS_YEAR = 2020
@@ -17,9 +28,29 @@ THIS_DIRECTORY = Path(__file__).parent
 ADDRESSES_FILE = "addresses.csv"
 SECRETS_FILE = "secrets.json"
 ADI_DATA_FOLDER = "adi-data"
+API_CACHE_FILE = "api-cache.sqlite"
+
+# Maximum number of addresses being looked up at the same time
+MAX_CONCURRENT_ADDRESSES = 20
+# Maximum number of addresses scheduled ahead of the output file (bounds memory use)
+MAX_PENDING_ADDRESSES = 100
+# Number of HTTP connections kept open to each web API (should be >= MAX_CONCURRENT_ADDRESSES)
+HTTP_POOL_SIZE = 20
+
+# Minimum number of seconds between consecutive calls to each web API
+# Google allows up to 50 geocoding requests per second
+GOOGLE_MIN_DELAY_SECONDS = 0.02
+# The FCC Area API does not publish a rate limit, so this is kept conservative
+FCC_MIN_DELAY_SECONDS = 0.1
+
+# Columns expected in the address file
+_ADDRESS_COLUMNS = ("street", "apt_num", "city", "state", "zip")
 
 # Used in loading data from ADI spreadsheet
-_GISJOIN_REGEX = re.compile("^G([0-9]{2})0([0-9]{3})0([0-9]{7})$")
+_GISJOIN_PATTERN = "^G[0-9]{2}0[0-9]{3}0[0-9]{7}$"
+_ADI_COLUMNS = ("GISJOIN", "FIPS", "ADI_STATERNK", "ADI_NATRANK")
+# Each block of the ADI CSV file is parsed by a separate thread (a national file has ~30 blocks)
+_ADI_CSV_BLOCK_SIZE = 1 << 20
 
 
 def json_to_dict(json_filepath: Path) -> dict:
@@ -38,7 +69,7 @@ def json_to_dict(json_filepath: Path) -> dict:
 
 
 def load_addresses() -> list[Location]:
-    locations = []
+    locations: list[Location] = []
     address_file_path = Path(THIS_DIRECTORY, ADDRESSES_FILE)
     if not address_file_path.is_file():
         print("Address file not found.")
@@ -49,23 +80,41 @@ def load_addresses() -> list[Location]:
         )
         return locations
     with open(address_file_path, "r+") as infile:
-        reader = csv.DictReader(infile)
+        reader = csv.reader(infile)
+        header = next(reader, [])
+        if not header:
+            print("Address file is empty.")
+            return locations
+        missing_columns = [column for column in _ADDRESS_COLUMNS if column not in header]
+        if missing_columns:
+            print(f"Address file is missing column(s): {', '.join(missing_columns)}")
+            return locations
+        # Column positions are looked up once, so each row is read as a plain list
+        street, apt_num, city, state, zipcode = (
+            header.index(column) for column in _ADDRESS_COLUMNS
+        )
         for row in reader:
+            # Blank lines (skipped by csv.DictReader) are read as empty lists
+            if not row:
+                continue
+            # Rows with fewer fields than the header are padded with "", so Location never gets None
+            if len(row) < len(header):
+                row += [""] * (len(header) - len(row))
             locations.append(
                 Location(
-                    row["street"],
-                    row["apt_num"],
-                    row["city"],
-                    row["state"],
-                    row["zip"],
-                    CENSUS_YEAR,
+                    row[street], row[apt_num], row[city], row[state], row[zipcode], CENSUS_YEAR
                 )
             )
     return locations
 
 
-def _gisjoin_to_fips(gisjoin: str) -> str:
-    """Converts a GISJOIN string to a standard FIPS code."""
+def _gisjoin_to_fips(gisjoin: "pa.ChunkedArray") -> "pa.ChunkedArray":
+    """Converts a column of GISJOIN strings to standard FIPS codes.
+    Strings that are not valid GISJOINs are converted to nulls.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
     # Example GISJOIN string:
     # G01000100208032
     # _SS_CCC_xxxxxxx
@@ -76,23 +125,76 @@ def _gisjoin_to_fips(gisjoin: str) -> str:
     # xxxxxxx = all the rest
 
     # 12-char FIPS code = SSCCCxxxxxxx
-    parsed_groups = _GISJOIN_REGEX.search(gisjoin).groups()
-    if (
-        len(parsed_groups) == 3
-        and len(parsed_groups[0]) == 2
-        and len(parsed_groups[1]) == 3
-        and len(parsed_groups[2]) == 7
-    ):
-        return "".join(parsed_groups)
-    print(f"Failed to convert GISJOIN {gisjoin} to FIPS")
-    return ""
+    is_valid = pc.match_substring_regex(gisjoin, _GISJOIN_PATTERN)
+    invalid_count = pc.sum(pc.invert(is_valid), min_count=0).as_py()
+    if invalid_count > 0:
+        print(f"Failed to convert {invalid_count} GISJOIN value(s) to FIPS")
+    fips = pc.binary_join_element_wise(
+        pc.utf8_slice_codeunits(gisjoin, 1, 3),
+        pc.utf8_slice_codeunits(gisjoin, 4, 7),
+        pc.utf8_slice_codeunits(gisjoin, 8, 15),
+        "",
+    )
+    return pc.if_else(is_valid, fips, pa.scalar(None, pa.string()))
+
+
+def _adi_cache_path(adi_csv: Path) -> Path:
+    """Returns the path of the binary cache file for an ADI CSV file (saved next to the CSV)."""
+    return adi_csv.with_suffix(".npz")
+
+
+def _load_one_adi_csv(adi_csv: Path) -> tuple[str, AdiTable]:
+    """Reads one ADI CSV file into an AdiTable.
+    Returns a 2-tuple: (ADI version string taken from the filename, AdiTable)
+    The parsed table is cached in a binary file next to the CSV file, which is read instead of the
+    CSV file on later runs (until the CSV file is replaced or modified).
+    """
+    cache_path = _adi_cache_path(adi_csv)
+    if cache_path.is_file():
+        try:
+            cached_adi_table = AdiTable.load(cache_path, adi_csv)
+            if cached_adi_table is not None:
+                return adi_csv.stem, cached_adi_table
+            print("ADI CSV file has changed since it was cached, re-reading the ADI CSV file")
+        except Exception as e:
+            print(f"Could not read cached ADI data, re-reading the ADI CSV file: {e}")
 
+    # print(f"* Reading local ADI file '{adi_csv.name}'")
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
 
-def load_adi_data() -> tuple[str, dict]:
+    # The whole file is parsed into columns by pyarrow's C++ CSV reader, straight from a memory map,
+    # with blocks of _ADI_CSV_BLOCK_SIZE bytes parsed on multiple threads.
+    # Everything is read as strings: FIPS codes have leading zeros, and ranks can be suppression codes
+    with pa.memory_map(str(adi_csv)) as adi_csv_source:
+        adi_table = pa_csv.read_csv(
+            adi_csv_source,
+            read_options=pa_csv.ReadOptions(use_threads=True, block_size=_ADI_CSV_BLOCK_SIZE),
+            convert_options=pa_csv.ConvertOptions(
+                column_types={name: pa.string() for name in _ADI_COLUMNS},
+                include_columns=list(_ADI_COLUMNS),
+                include_missing_columns=True,
+            ),
+        )
+    # Columns missing from the CSV file are read as all nulls
+    csv_has_gisjoin_only = adi_table["FIPS"].null_count == adi_table.num_rows
+    fips = _gisjoin_to_fips(adi_table["GISJOIN"]) if csv_has_gisjoin_only else adi_table["FIPS"]
+    # Rows whose GISJOIN could not be converted (null FIPS) are dropped
+    fips_to_adi_ranks = AdiTable.from_columns(
+        fips, adi_table["ADI_STATERNK"], adi_table["ADI_NATRANK"]
+    )
+    try:
+        fips_to_adi_ranks.save(cache_path, adi_csv)
+    except Exception as e:
+        print(f"Could not cache ADI data (this only affects the next run's start-up time): {e}")
+    return adi_csv.stem, fips_to_adi_ranks
+
+
+def load_adi_data() -> tuple[str, AdiTable]:
     """Reads a CSV file of ADI data downloaded from the Wisconsin Neighborhood Atlas project.
     Returns a 2-tuple:
         1. A string containing the filename of the CSV file (to keep track of ADI version)
-        2. A dict of all 12-digit FIPS codes to a tuple of each code's state rank and national rank
+        2. An AdiTable of all 12-digit FIPS codes to a tuple of each code's state rank and national rank
     Assumes the following columns exist in the ADI CSV file:
         "GISJOIN" (but prioritizes "FIPS" if that column exists)
         "ADI_STATERNK"
@@ -100,7 +202,7 @@ def load_adi_data() -> tuple[str, dict]:
     This function will need further development if newer ADI releases have different data or column names.
     """
     adi_downloads_folder_path = Path(THIS_DIRECTORY, ADI_DATA_FOLDER)
-    fips_to_adi_ranks = dict()
+    fips_to_adi_ranks = AdiTable()
     if not adi_downloads_folder_path.is_dir():
         print("ADI data folder not found.")
         adi_downloads_folder_path.mkdir()
@@ -112,62 +214,228 @@ def load_adi_data() -> tuple[str, dict]:
     adi_downloads_csvs = [f for f in adi_downloads_folder_path.iterdir() if f.suffix == ".csv"]
     if len(adi_downloads_csvs) != 1:
         # print(f"Expected only 1 ADI CSV file (found {len(adi_downloads_csvs)})")
-        return fips_to_adi_ranks
+        return ("", fips_to_adi_ranks)
 
-    with open(adi_downloads_csvs[0]) as infile:
-        # print(f"* Reading local ADI file '{adi_downloads_csvs[0].name}'")
-        reader = csv.DictReader(infile)
-        csv_has_gisjoin_only = "GISJOIN" in reader.fieldnames and "FIPS" not in reader.fieldnames
+    return _load_one_adi_csv(adi_downloads_csvs[0])
 
-        for row in reader:
-            # How data should be stored in fips_to_adi_ranks: fips_to_adi_ranks[fips] = (state, national)
-            fips = _gisjoin_to_fips(row["GISJOIN"]) if csv_has_gisjoin_only else row["FIPS"]
-            fips_to_adi_ranks[fips] = (row["ADI_STATERNK"], row["ADI_NATRANK"])
-    adi_version_str = adi_downloads_csvs[0].stem
-    return adi_version_str, fips_to_adi_ranks
+
+def _write_locations(
+    outfile: TextIO, locations: "queue.Queue[Location | None]", errors: list[Exception]
+) -> None:
+    """Writes Locations from a queue to an open CSV file until None is received.
+    The file is flushed to disk whenever the queue is empty, so a run that is interrupted still
+    leaves every finished Location in the output file.
+    Runs in a background thread, so an error is added to `errors` (and stops the writing)
+    instead of being raised.
+    """
+    try:
+        writer = csv.writer(outfile, lineterminator="\n")
+        writer.writerow(OUTPUT_FIELDS)
+        while (location := locations.get()) is not None:
+            writer.writerow(location.prep_for_output())
+            if locations.empty():
+                outfile.flush()
+    except Exception as e:
+        errors.append(e)
 
 
-def write_output_csv(data: list[Location]) -> Path:
-    if len(data) < 1:
-        return Path()
+def write_output_csv(data: Iterable[Location]) -> Path:
+    """Writes each Location to a new timestamped CSV file as soon as it is received.
+    Returns the path of the file written.
+    Locations are written by a background thread, so writing to disk overlaps with producing
+    (i.e. looking up) the next Locations. If writing fails, no more Locations are taken from
+    `data`, and the error is raised here.
+    """
     new_csv_file = Path(
         THIS_DIRECTORY, f"addresses-output-{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
     )
 
-    field_names = asdict(data[0]).keys()
-    with open(new_csv_file, "w+", encoding="utf-8") as outfile:
-        writer = csv.DictWriter(outfile, fieldnames=field_names, lineterminator="\n")
-        writer.writeheader()
-        for location in data:
-            writer.writerow(asdict(location))
+    with open(new_csv_file, "w+", encoding="utf-8", buffering=1 << 20) as outfile:
+        location_queue: queue.Queue[Location | None] = queue.Queue()
+        write_errors: list[Exception] = []
+        writer_thread = threading.Thread(
+            target=_write_locations, args=(outfile, location_queue, write_errors)
+        )
+        writer_thread.start()
+        try:
+            for location in data:
+                if not writer_thread.is_alive():
+                    break
+                location_queue.put(location)
+        finally:
+            # Tells the writer thread to stop once every Location received so far is written
+            location_queue.put(None)
+            writer_thread.join()
+        if write_errors:
+            raise write_errors[0]
     return new_csv_file
 
 
+class PermanentGeocoderError(Exception):
+    """A geocoding error that would happen again if retried (e.g. REQUEST_DENIED)."""
+
+
+def _raise_permanent_errors(geocode: Callable[..., Any]) -> Callable[..., Any]:
+    """Wraps a geocoder's `geocode` method so that only temporary errors (quota exceeded, timed out,
+    or unavailable) are raised as geopy errors, which geopy's RateLimiter retries.
+    Any other geopy error is raised as a PermanentGeocoderError, which RateLimiter does not retry.
+    """
+    from geopy.exc import (
+        GeocoderQuotaExceeded,
+        GeocoderServiceError,
+        GeocoderTimedOut,
+        GeocoderUnavailable,
+    )
+
+    @functools.wraps(geocode)
+    def geocode_raising_permanent_errors(*args: Any, **kwargs: Any) -> Any:
+        try:
+            return geocode(*args, **kwargs)
+        except (GeocoderQuotaExceeded, GeocoderTimedOut, GeocoderUnavailable):
+            raise
+        except GeocoderServiceError as e:
+            raise PermanentGeocoderError(str(e)) from e
+
+    return geocode_raising_permanent_errors
+
+
+def find_unique_locations(locations: list[Location]) -> dict[str, Location]:
+    """Returns the first Location with each distinct address (ignoring case and spacing),
+    keyed by that address's Location.get_address_key().
+    Only these Locations are looked up; the rest copy their results.
+    """
+    first_location_by_address: dict[str, Location] = {}
+    for location in locations:
+        first_location_by_address.setdefault(location.get_address_key(), location)
+    return first_location_by_address
+
+
+def process_locations(
+    locations: list[Location],
+    first_location_by_address: dict[str, Location],
+    geocode: "RateLimiter",
+    fcc_get: "RateLimiter",
+    adi_ver: str,
+    adi_data: AdiTable,
+    cache: ApiCache,
+) -> Iterator[Location]:
+    """Looks up coordinates, FIPS codes, and ADI rankings for all Locations concurrently,
+    on a pool of MAX_CONCURRENT_ADDRESSES worker threads.
+    Each Location is yielded (in input order) as soon as it and every Location before it are done,
+    so results can be written while later Locations are processed. Workers move on to the next
+    Location right away; at most MAX_PENDING_ADDRESSES Locations are scheduled ahead of the last
+    Location yielded.
+    A Location that is not the first with its address (see find_unique_locations()) is not
+    looked up again; it copies the first Location's results instead (which are always done
+    before it is yielded).
+    """
+    # Scheduled Locations, in input order: (address number, Location, earlier Location with the
+    # same address, lookup of the Location or None if it copies the earlier Location's results)
+    pending: deque[tuple[int, Location, Location, Future[None] | None]] = deque()
+
+    def finish_oldest() -> Location:
+        i, location, first_location, lookup = pending.popleft()
+        if lookup is not None:
+            lookup.result()
+            messages = location.pop_messages()
+        else:
+            location.copy_results(first_location)
+            messages = ["Same address as an earlier address; copied its results"]
+        # Printed from this thread only, in input order, so each address's messages stay together
+        print(f"Finished address {i}/{len(locations)}")
+        for message in messages:
+            print(f"    {message}")
+        return location
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_ADDRESSES) as executor:
+        for i, location in enumerate(locations, start=1):
+            first_location = first_location_by_address[location.get_address_key()]
+            lookup = None
+            if first_location is location:
+                lookup = executor.submit(
+                    location.process, geocode, fcc_get, adi_ver, adi_data, cache
+                )
+            pending.append((i, location, first_location, lookup))
+            if len(pending) > MAX_PENDING_ADDRESSES:
+                yield finish_oldest()
+        while pending:
+            yield finish_oldest()
+
+
 def main() -> None:
     print("Starting....")
     locations = load_addresses()
     if len(locations) == 0:
         return
-    print(f"Got {len(locations)} address(es)")
+    # Repeated addresses are only looked up once (in the cache, in bulk, and one by one)
+    first_location_by_address = find_unique_locations(locations)
+    unique_locations = list(first_location_by_address.values())
+    print(f"Got {len(locations)} address(es) ({len(unique_locations)} unique)")
 
     # Pre-load shared resources for all addresses
     secrets = json_to_dict(Path(THIS_DIRECTORY, SECRETS_FILE))
     if "google_cloud_api_key" not in secrets:
         return
-    main_geocoder = GoogleV3(secrets["google_cloud_api_key"])
     adi_ver, adi_data = load_adi_data()
     if len(adi_data) == 0:
         return
 
-    for i, location in enumerate(locations, start=1):
-        print(f"Address {i}/{len(locations)}:")
-        print("    Getting latitude/longitude coords....")
-        location.get_latlong(main_geocoder)
-        print("    Getting FIPS code....")
-        location.get_fips()
-        print("    Looking up ADI rankings....")
-        location.get_adi(adi_ver, adi_data)
-    file_written = write_output_csv(locations)
+    import requests
+    from geopy.adapters import RequestsAdapter
+    from geopy.extra.rate_limiter import RateLimiter
+    from geopy.geocoders import GoogleV3
+    from requests.adapters import HTTPAdapter
+    from urllib3.util import Retry
+
+    # Each API gets one pool of keep-alive HTTP connections, reused for all addresses
+    google_adapter_factory = functools.partial(
+        RequestsAdapter, pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE
+    )
+    with (
+        GoogleV3(
+            secrets["google_cloud_api_key"], adapter_factory=google_adapter_factory
+        ) as main_geocoder,
+        requests.Session() as http_session,
+        ApiCache(Path(THIS_DIRECTORY, API_CACHE_FILE)) as cache,
+    ):
+        # Failed connections and temporary server errors are retried with exponential backoff
+        # (only for idempotent requests, so the Census batch upload is not sent twice)
+        http_retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+        http_session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=HTTP_POOL_SIZE,
+                pool_maxsize=HTTP_POOL_SIZE,
+                max_retries=http_retry,
+            ),
+        )
+
+        # Rate limiting: temporary geocoding errors (e.g. 429 Too Many Requests) are retried after a
+        # short wait. Other errors (e.g. REQUEST_DENIED for an invalid API key) are not retried, and
+        # every error is raised so Location.get_latlong() reports it instead of trying the alternate
+        # address.
+        geocode = RateLimiter(
+            _raise_permanent_errors(main_geocoder.geocode),
+            min_delay_seconds=GOOGLE_MIN_DELAY_SECONDS,
+            max_retries=3,
+            error_wait_seconds=5.0,
+            swallow_exceptions=False,
+        )
+        fcc_get = RateLimiter(http_session.get, min_delay_seconds=FCC_MIN_DELAY_SECONDS)
+
+        # Results saved by earlier runs are reused; no API calls are made for those addresses
+        cached_count = sum(location.load_cached(cache) for location in unique_locations)
+        print(f"Found {cached_count}/{len(unique_locations)} unique address(es) in the API cache")
+
+        # Addresses are first looked up in bulk; the rest are geocoded and looked up one by one
+        print("Getting coordinates and FIPS codes from the US Census Geocoder....")
+        fips_found = Location.batch_fips(unique_locations, http_session.post, cache)
+        print(f"Matched {fips_found}/{len(unique_locations)} unique address(es) in bulk")
+
+        processed_locations = process_locations(
+            locations, first_location_by_address, geocode, fcc_get, adi_ver, adi_data, cache
+        )
+        file_written = write_output_csv(processed_locations)
     print(f"Wrote data to CSV file:\n\t{file_written}")
     print("Done!")
     return